@@ -1,16 +1,40 @@
+import array
 import logging
+import sys
+
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    # numba is optional, without it _run is executed as plain Python
+    np = None
+
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 ## Setting up logging for Debug messages
 FORMAT = "%(message)s"
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.WARNING)
 
 ## Constants
 TRUE = 1
 FALSE = 0
 
-INSTRUCTIONS = {
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# Constant parts of the StackMachine.display output, the separator and
+# margin are printed before every row
+DISPLAY_ROW = "----------------\n\t"
+DISPLAY_HEADER = "\n\tTOP\n"
+DISPLAY_FOOTER = DISPLAY_ROW + "BOTTOM\n\n"
+
+# Number of written values collected before they are flushed to stdout
+WRITE_BUFFER_SIZE = 256
+
+INSTRUCTIONS = frozenset({
     "add", 
     "negate", 
     "equal", 
@@ -23,82 +47,331 @@ INSTRUCTIONS = {
     "mpy",
     "write",
     "swap",
-    "less"}
+    "less"})
+
+# Fused instructions only emitted by the optimize pass
+SUPERINSTRUCTIONS = frozenset({
+    "is_negative",
+    "br_abs",
+    "br_false_abs",
+    "br_if_ge",
+    "br_if_ne"})
+
+# Instructions that carry a value, branch targets are absolute program counters
+IMMEDIATE_INSTRUCTIONS = frozenset({
+    "loadcon",
+    "br_abs",
+    "br_false_abs",
+    "br_if_ge",
+    "br_if_ne"})
+
+# Opcode ids used by the StackMachine dispatch table
+OPCODE_NAMES = tuple(sorted(INSTRUCTIONS | SUPERINSTRUCTIONS))
+OPCODE_IDS = {name: i for i, name in enumerate(OPCODE_NAMES)}
+ADD_ID = OPCODE_IDS["add"]
+BR_ID = OPCODE_IDS["br"]
+BR_ABS_ID = OPCODE_IDS["br_abs"]
+BR_FALSE_ID = OPCODE_IDS["br_false"]
+BR_FALSE_ABS_ID = OPCODE_IDS["br_false_abs"]
+BR_IF_GE_ID = OPCODE_IDS["br_if_ge"]
+BR_IF_NE_ID = OPCODE_IDS["br_if_ne"]
+DUP_ID = OPCODE_IDS["dup"]
+EQUAL_ID = OPCODE_IDS["equal"]
+IS_NEGATIVE_ID = OPCODE_IDS["is_negative"]
+LESS_ID = OPCODE_IDS["less"]
+LOADCON_ID = OPCODE_IDS["loadcon"]
+MPY_ID = OPCODE_IDS["mpy"]
+NEGATE_ID = OPCODE_IDS["negate"]
+ONE_ID = OPCODE_IDS["one"]
+SWAP_ID = OPCODE_IDS["swap"]
+WRITE_ID = OPCODE_IDS["write"]
+ZERO_ID = OPCODE_IDS["zero"]
+IMMEDIATE_IDS = frozenset(OPCODE_IDS[name] for name in IMMEDIATE_INSTRUCTIONS)
+
+# (values popped, values pushed) by every opcode, used by verify
+STACK_EFFECTS = {
+    ADD_ID: (2, 1),
+    BR_ID: (1, 0),
+    BR_ABS_ID: (0, 0),
+    BR_FALSE_ID: (2, 0),
+    BR_FALSE_ABS_ID: (1, 0),
+    BR_IF_GE_ID: (2, 0),
+    BR_IF_NE_ID: (2, 0),
+    DUP_ID: (1, 2),
+    EQUAL_ID: (2, 1),
+    IS_NEGATIVE_ID: (1, 2),
+    LESS_ID: (2, 1),
+    LOADCON_ID: (0, 1),
+    MPY_ID: (2, 1),
+    NEGATE_ID: (1, 1),
+    ONE_ID: (0, 1),
+    SWAP_ID: (2, 2),
+    WRITE_ID: (1, 0),
+    ZERO_ID: (0, 1)}
 
 class Stack:
     """ Implementation of stack abstract data type
     Supports push, pop and len operations
     """
     
-    def __init__(self, size_limit, elements=[]):
-        self._stack_elements = []
+    def __init__(self, size_limit, elements=None, int64=True):
+        """
+            Parameters:
+                size_limit (int): the maximum number of elements
+                elements (list): the initial elements, from the bottom up
+                int64 (bool): hold the elements in an int64 array.array, which
+                falls back to a list once anything else is pushed
+        """
+        # Backing store is preallocated, _top is the index of the next free slot
+        if int64:
+            self._elements = array.array("q", [0]) * size_limit
+        else:
+            self._elements = [None] * size_limit
         self._size_limit = size_limit
-        if len(elements) > size_limit:
-            raise Exception("Stack elements exceed stack size limit")
-        if len(elements) > 0:
-            self._stack_elements.extend(elements)
+        self._top = 0
+        if elements:
+            if len(elements) > size_limit:
+                raise Exception("Stack elements exceed stack size limit")
+            for elem in elements:
+                self.push(elem)
     
     def get_stack_elements(self):
-        return self._stack_elements
+        return list(self._elements[:self._top])
+
+    def iter_top_down(self):
+        """Yields the stack elements from the top to the bottom"""
+        elements = self._elements
+        for index in range(self._top - 1, -1, -1):
+            yield elements[index]
 
     def pop(self):
-        if len(self._stack_elements) > 0:
-            return self._stack_elements.pop(-1)
+        if self._top:
+            self._top -= 1
+            return self._elements[self._top]
         return None
     
     def push(self, elem):
-        if len(self._stack_elements) + 1 > self._size_limit:
-            print("The stack is full, could not push " + str(elem))
-            return 
-        self._stack_elements.append(elem)
+        if self._top < self._size_limit:
+            try:
+                self._elements[self._top] = elem
+            except (TypeError, OverflowError):
+                # not an int64, so the array can't hold it
+                self._elements = list(self._elements)
+                self._elements[self._top] = elem
+            self._top += 1
+            return
+        print("The stack is full, could not push " + str(elem))
     
     def __len__(self):
-        return len(self._stack_elements)
+        return self._top
     
     def __str__(self):
-        return f"Stack with {self._stack_elements}"
+        return f"Stack with {self.get_stack_elements()}"
     
     def __repr__(self):
-        return f"Stack({self._size_limit}, {self._stack_elements})"
+        return f"Stack({self._size_limit}, {self.get_stack_elements()})"
+
+
+def lookup_opcode(instruction_name, instruction_value=None):
+    """Returns the opcode id of an instruction. Raises a KeyError for names
+    not in the INSTRUCTIONS or SUPERINSTRUCTIONS set, and an Exception for a
+    value given to an instruction not in the IMMEDIATE_INSTRUCTIONS set"""
+    try:
+        opcode = OPCODE_IDS[instruction_name]
+    except KeyError:
+        raise KeyError(f"Invalid instruction: {instruction_name}") from None
+
+    if opcode not in IMMEDIATE_IDS and instruction_value is not None:
+        raise Exception("Unexpected instruction value given for non LOADCON call")
+    return opcode
 
 
 class Instruction:
+    """Human readable view of a single decoded instruction, the StackMachine
+    itself only works on the (ops, vals) program arrays"""
+
     def __init__(self, instruction_name, instruction_value=None):
-        """Only loadcon instructions have a value
+        """Only loadcon and absolute branch instructions have a value
             Parameters:
                 instruction_name (str): the name of the instruction, 
-                should be in the INSTRUCTIONS set
-                instructions_value (int): (None for all non-load con instructions, else int)
+                should be in the INSTRUCTIONS or SUPERINSTRUCTIONS set
+                instructions_value (int): (None for all instructions not in
+                the IMMEDIATE_INSTRUCTIONS set, else int)
         """
-        if instruction_name not in INSTRUCTIONS:
-            raise Exception("Invalid instruction: ", instruction_name)
-
+        self._opcode = lookup_opcode(instruction_name, instruction_value)
         self._instruction_name = instruction_name
         self._instruction_value = instruction_value
-
-        if "loadcon" not in instruction_name and instruction_value is not None:
-            raise Exception("Unexpected instruction value given for non LOADCON call")
     
     def get_instruction_name(self):
         return self._instruction_name
 
+    def get_opcode(self):
+        return self._opcode
+
     def get_instruction_value(self):
         return self._instruction_value
 
     def __repr__(self):
-        value = "" if not self._instruction_value else f" {self._instruction_value}"
+        value = "" if self._instruction_value is None else f" {self._instruction_value}"
         return self._instruction_name + value
 
 
+@njit(cache=True)
+def _run(ops, vals, stack, top, pc):
+    """Executes a verified program from pc with the opcodes inlined and no
+    stack checks. Stops at the end of the program, at a write, or at an add,
+    mpy or negate whose result doesn't fit in an int64, leaving that opcode
+    to the caller. Returns the new (top, pc).
+
+    The top of the stack is cached in tos, so while the stack is not
+    empty stack[top - 1] is stale until a push spills tos or _run returns.
+    The int64 range is checked before the arithmetic, as numba may assume
+    that the arithmetic itself never overflows
+    """
+    program_length = len(ops)
+    tos = stack[top - 1] if top else 0
+
+    while pc < program_length:
+        op = ops[pc]
+
+        # The arms are ordered by how often an optimized countdown loop and
+        # ABSOLUTE_FN execute each opcode, so the common opcodes are found
+        # after the fewest compares. loadcon comes first, as straight line
+        # programs like ABSOLUTE_FN are mostly loadcons. The opcodes neither
+        # executes follow. Similar arms such as zero and one are kept separate
+        if op == LOADCON_ID:
+            if top:
+                stack[top - 1] = tos
+            tos = vals[pc]
+            top += 1
+        elif op == DUP_ID:
+            stack[top - 1] = tos
+            top += 1
+        elif op == ADD_ID:
+            second_top = stack[top - 2]
+            if (tos > 0 and second_top > INT64_MAX - tos) or (tos < 0 and second_top < INT64_MIN - tos):
+                break
+            top -= 1
+            tos = second_top + tos
+        elif op == BR_IF_NE_ID:
+            top -= 2
+            if stack[top] != tos:
+                pc = vals[pc] - 1
+            if top:
+                tos = stack[top - 1]
+        elif op == ONE_ID:
+            if top:
+                stack[top - 1] = tos
+            tos = 1
+            top += 1
+        elif op == NEGATE_ID:
+            if tos == INT64_MIN:
+                break
+            tos = tos * -1
+        elif op == ZERO_ID:
+            if top:
+                stack[top - 1] = tos
+            tos = 0
+            top += 1
+        elif op == EQUAL_ID:
+            top -= 1
+            tos = TRUE if stack[top - 1] == tos else FALSE
+        elif op == LESS_ID:
+            top -= 1
+            tos = TRUE if stack[top - 1] < tos else FALSE
+        elif op == MPY_ID:
+            second_top = stack[top - 2]
+            if second_top and tos and (second_top == INT64_MIN or tos == INT64_MIN
+                    or abs(tos) > INT64_MAX // abs(second_top)):
+                break
+            top -= 1
+            tos = second_top * tos
+        elif op == IS_NEGATIVE_ID:
+            stack[top - 1] = tos
+            tos = TRUE if tos < 0 else FALSE
+            top += 1
+        elif op == SWAP_ID:
+            stack[top - 2], tos = tos, stack[top - 2]
+        elif op == BR_ABS_ID:
+            pc = vals[pc] - 1
+        elif op == BR_IF_GE_ID:
+            top -= 2
+            if stack[top] >= tos:
+                pc = vals[pc] - 1
+            if top:
+                tos = stack[top - 1]
+        elif op == BR_FALSE_ABS_ID:
+            top -= 1
+            if tos != TRUE:
+                pc = vals[pc] - 1
+            if top:
+                tos = stack[top - 1]
+        else:
+            # write is left to the caller
+            break
+
+        pc += 1
+
+    if top:
+        stack[top - 1] = tos
+    return top, pc
+
+
 class StackMachine:
-    def __init__(self, instructions, stack_size= 10):
-        self._value_stack = Stack(stack_size)
+    def __init__(self, program, stack_size= 10, trace=False):
+        """
+            Parameters:
+                program (tuple): the (ops, vals) arrays to execute, as
+                returned by convert_list_to_instructions
+                stack_size (int): the size limit of the value stack
+                trace (bool): log and display the stack after every instruction,
+                the program is only verified and optimized when this is off
+        """
         self._size_limit = stack_size
-        self._instructions = instructions
+        self._trace = trace
+        self._program = program
         self._program_counter = 0 # the address of the next machine instruction
+
+        # (opcode id, value) pairs of the source program for the opcode
+        # methods. It is verified before optimize, which drops the stack
+        # accesses of the sequences it fuses
+        self._decoded = tuple(zip(*program))
+        self._verified = not trace and verify(self._decoded, stack_size)
+
+        # Flat opcode and value arrays of the optimized program for _run,
+        # compiled by numba when every value fits in an int64
+        ops, vals = optimize(program) if self._verified else ((), ())
+        self._ops = list(ops)
+        # verified loadcons all have a value, the other opcodes ignore theirs
+        self._vals = [0 if value is None else value for value in vals]
+        self._compiled = self._verified and np is not None and all(
+            type(value) is int and INT64_MIN <= value <= INT64_MAX for value in self._vals)
+        self._run_program = _run
+        if self._compiled:
+            self._ops = np.array(self._ops, dtype=np.int64)
+            self._vals = np.array(self._vals, dtype=np.int64)
+        elif np is not None:
+            self._run_program = _run.py_func
+
+        # numba works on the int64 array backing the stack in place, while
+        # plain Python uses a list so that values can grow past an int64
+        self._value_stack = Stack(stack_size, int64=self._compiled)
+        self._dispatch = [getattr(self, name) for name in OPCODE_NAMES]
+
+    @classmethod
+    def from_source(cls, lines, stack_size=10, trace=False):
+        """Parses, optimizes and decodes a program given as source lines
+        (e.g. ["loadcon 2", "dup", "add"]) once, returning a StackMachine
+        that is ready to run"""
+        return cls(convert_list_to_instructions(lines), stack_size, trace)
     
     def get_value_stack(self):
         return self._value_stack
+
+    def get_instructions(self):
+        """Builds Instruction objects for the program, for display only"""
+        ops, vals = self._program
+        return [Instruction(OPCODE_NAMES[op], value) for op, value in zip(ops, vals)]
     
     def display(self):
         """
@@ -118,50 +391,101 @@ class StackMachine:
             BOTTOM
         """
 
-        row = "----------------\n"
-        margins = "\t"
-        output = ["\n"]
-
-        output.append(margins)
-        output.append("TOP\n")
-
-        for elem in self._value_stack.get_stack_elements()[::-1]:
-            output.append(row)
-            output.append(margins)
-            output.append(str(elem))
-            output.append("\n")
-        
-        output.append(row)
-        output.append(margins)
-        output.append("BOTTOM\n\n")
-
-        output = "".join(output)
-        
-        print(output)
+        rows = "".join([f"{DISPLAY_ROW}{elem}\n" for elem in self._value_stack.iter_top_down()])
+        sys.stdout.write(DISPLAY_HEADER + rows + DISPLAY_FOOTER + "\n")
     
     
     def run(self):
         logging.info("Starting Execution of Stack Machine")
-        
-        while True:
-            if not (self._program_counter > (len(self._instructions) - 1)):
-                current_instruction = self._instructions[self._program_counter]
-            else:
-                break
 
-            logging.info("Executing: %s", current_instruction)
+        if self._verified:
+            self._run_inlined()
+        else:
+            self._run_stepped()
 
-            func = getattr(self, current_instruction.get_instruction_name(), None)
+        logging.info("Execution has finished")
 
-            if current_instruction.get_instruction_name() == "loadcon":
-                func(current_instruction.get_instruction_value())
+    def _run_inlined(self):
+        """Runs the program with _run, which hands control back for every
+        write. Nothing else prints meanwhile, so the written values are
+        batched and flushed to stdout every WRITE_BUFFER_SIZE values.
+        An add, mpy or negate handed back for leaving the int64 range is
+        executed by its opcode method with Python ints. Once that happens
+        under numba, the rest of the program runs as plain Python on a
+        list backed stack"""
+        value_stack = self._value_stack
+        elements = value_stack._elements
+        ops = self._ops
+        vals = self._vals
+        program_length = len(ops)
+        output = []
+
+        # write only pops, so the stack keeps its backing store throughout
+        if self._compiled:
+            stack = np.frombuffer(elements, dtype=np.int64)
+        else:
+            stack = elements
+        
+        top = value_stack._top
+        pc = self._program_counter
+
+        try:
+            while True:
+                top, pc = self._run_program(ops, vals, stack, top, pc)
+                if pc >= program_length:
+                    break
+
+                if ops[pc] != WRITE_ID:
+                    if self._compiled:
+                        elements = stack = value_stack._elements = elements.tolist()
+                        ops = self._ops = ops.tolist()
+                        vals = self._vals = vals.tolist()
+                        self._run_program = _run.py_func
+                        self._compiled = False
+                    value_stack._top = top
+                    self._dispatch[ops[pc]]()
+                    top = value_stack._top
+                    pc += 1
+                    continue
+
+                top -= 1
+                output.append(f"\t\t\t {elements[top]}\n")
+                if len(output) >= WRITE_BUFFER_SIZE:
+                    sys.stdout.write("".join(output))
+                    output.clear()
+                pc += 1
+        finally:
+            value_stack._top = top
+            self._program_counter = pc
+            if output:
+                sys.stdout.write("".join(output))
+
+    def _run_stepped(self):
+        """Runs the program one opcode method at a time, checking the stack
+        before every instruction. When tracing, the stack is displayed after
+        every instruction"""
+        decoded = self._decoded
+        dispatch = self._dispatch
+        trace = self._trace
+        log_instructions = trace and logger.isEnabledFor(logging.INFO)
+        if log_instructions:
+            instructions = self.get_instructions()
+
+        while self._program_counter < len(decoded):
+            if log_instructions:
+                logger.info("Executing: %s", instructions[self._program_counter])
+
+            op, value = decoded[self._program_counter]
+            func = dispatch[op]
+
+            if op in IMMEDIATE_IDS:
+                func(value)
             else:
                 func()
             
-            self.display()
+            if trace:
+                self.display()
             self._program_counter += 1
-
-        logging.info("Execution has finished")
     
     def loadcon(self, value):
         self._value_stack.push(value)
@@ -186,6 +510,43 @@ class StackMachine:
         if check_condition != TRUE:
             self._program_counter += offset_index
 
+    def br_abs(self, target):
+        self._program_counter = target - 1
+    
+    def br_false_abs(self, target):
+        if len(self._value_stack) < 1:
+            logging.info("Stack too small to execute br_false_abs")
+            return
+        
+        check_condition = self._value_stack.pop()
+
+        if check_condition != TRUE:
+            self._program_counter = target - 1
+
+    def br_if_ge(self, target):
+        """Branches to target if the second value is >= the top, popping both"""
+        if len(self._value_stack) < 2:
+            logging.info("Stack too small to execute br_if_ge")
+            return
+        
+        top = self._value_stack.pop()
+        second_top = self._value_stack.pop()
+
+        if second_top >= top:
+            self._program_counter = target - 1
+    
+    def br_if_ne(self, target):
+        """Branches to target if the top two values differ, popping both"""
+        if len(self._value_stack) < 2:
+            logging.info("Stack too small to execute br_if_ne")
+            return
+        
+        value_1 = self._value_stack.pop()
+        value_2 = self._value_stack.pop()
+
+        if value_1 != value_2:
+            self._program_counter = target - 1
+
     def add(self):
         """Adds the top two elements on the stack. 
         Returns the result on the top of the stack"""
@@ -258,7 +619,7 @@ class StackMachine:
             return
         
         value = self._value_stack.pop()
-        print("\t\t\t", value)
+        sys.stdout.write(f"\t\t\t {value}\n")
     
     def dup(self):
         if len(self._value_stack) < 1:
@@ -269,35 +630,228 @@ class StackMachine:
         self._value_stack.push(value)
         self._value_stack.push(value)
     
+    def is_negative(self):
+        """Pushes TRUE if the top of the stack value is below zero, else FALSE"""
+        if len(self._value_stack) < 1:
+            logging.info("Stack too small to execute is_negative")
+            return
+        
+        value = self._value_stack.pop()
+        self._value_stack.push(value)
+        self._value_stack.push(TRUE if value < 0 else FALSE)
+    
     def __str__(self):
-        return f"Stack Machine\n\tInstructions: {self._instructions}\n\tStack Values: {self._value_stack}"
+        return f"Stack Machine\n\tInstructions: {self.get_instructions()}\n\tStack Values: {self._value_stack}"
     
     def __repr__(self):
-        return f"StackMachine({self._instructions}, {self._size_limit})"
+        return f"StackMachine({self.get_instructions()}, {self._size_limit})"
 
 
 def convert_list_to_instructions(instructions):
-    conv_instructions = []
+    """Parses source lines into a program of two equally long arrays, an
+    array.array of opcode ids and a list of values (None for instructions
+    without one). Raises a KeyError for names not in the INSTRUCTIONS set,
+    as source branch offsets are only resolved by optimize"""
+    ops = array.array("i")
+    vals = []
     for instruction in instructions:
         x = instruction.split(" ")
         if len(x) == 2:
             instruction_name = x[0].lower()
             instruction_value = int(x[1])
-            conv_instructions.append(Instruction(instruction_name, instruction_value))
         else:
-            conv_instructions.append(Instruction(instruction.lower()))
-    return conv_instructions
+            instruction_name = instruction.lower()
+            instruction_value = None
+        if instruction_name in SUPERINSTRUCTIONS:
+            raise KeyError(f"Invalid instruction: {instruction_name}")
+        ops.append(lookup_opcode(instruction_name, instruction_value))
+        vals.append(instruction_value)
+    return ops, vals
+
+def optimize(program):
+    """Peephole pass fusing common instruction sequences of an (ops, vals) program
+        loadcon N, negate   ->  loadcon -N
+        dup, zero, less     ->  is_negative
+        zero, add           ->  (removed)
+        loadcon K, br       ->  br_abs (target)
+        loadcon K, br_false ->  br_false_abs (target)
+        less, loadcon K, br_false  ->  br_if_ge (target)
+        equal, loadcon K, br_false ->  br_if_ne (target)
+
+    The branch targets are resolved to absolute indexes in the shorter program.
+    The fused instructions only behave differently from the sequences they
+    replace on a stack too empty or too full for them, and verify rejects
+    such programs before they are optimized.
+    Programs where a branch offset is not loaded by the loadcon right before it
+    are returned unchanged, as their branch targets are only known at run time.
+    """
+    ops, vals = program
+    program_length = len(ops)
+
+    # The absolute target of every branch, keyed by the index of the branch
+    targets = {}
+    for index, op in enumerate(ops):
+        if op != BR_ID and op != BR_FALSE_ID:
+            continue
+        if index == 0 or ops[index - 1] != LOADCON_ID or vals[index - 1] is None:
+            return program
+        target = index + 1 + vals[index - 1]
+        if target < 0:
+            return program
+        targets[index] = min(target, program_length)
+
+    jump_targets = set(targets.values())
+    if jump_targets & targets.keys():
+        # jumping straight onto a branch skips the loadcon for its offset
+        return program
+
+    optimized_ops = array.array("i")
+    optimized_vals = []
+    new_index = [] # the index in the optimized program of each original instruction
+    index = 0
+    while index < program_length:
+        window = tuple(ops[index:index + 3])
+        if window == (DUP_ID, ZERO_ID, LESS_ID) and not jump_targets & {index + 1, index + 2}:
+            fused = [(IS_NEGATIVE_ID, None)]
+        elif window == (LESS_ID, LOADCON_ID, BR_FALSE_ID) and index + 1 not in jump_targets:
+            # the absolute targets of all branches are filled in below
+            fused = [(BR_IF_GE_ID, None)]
+        elif window == (EQUAL_ID, LOADCON_ID, BR_FALSE_ID) and index + 1 not in jump_targets:
+            fused = [(BR_IF_NE_ID, None)]
+        elif (window[:2] == (LOADCON_ID, NEGATE_ID) and index + 1 not in jump_targets
+                and vals[index] is not None):
+            fused = [(LOADCON_ID, -vals[index])]
+            window = window[:2]
+        elif window[:2] == (LOADCON_ID, BR_ID):
+            fused = [(BR_ABS_ID, None)]
+            window = window[:2]
+        elif window[:2] == (LOADCON_ID, BR_FALSE_ID):
+            fused = [(BR_FALSE_ABS_ID, None)]
+            window = window[:2]
+        elif window[:2] == (ZERO_ID, ADD_ID) and index + 1 not in jump_targets:
+            fused = []
+            window = window[:2]
+        else:
+            fused = [(ops[index], vals[index])]
+            window = window[:1]
+
+        new_index.extend([len(optimized_ops)] * len(window))
+        for op, value in fused:
+            optimized_ops.append(op)
+            optimized_vals.append(value)
+        index += len(window)
+    new_index.append(len(optimized_ops)) # branching past the last instruction
+
+    for index, target in targets.items():
+        optimized_vals[new_index[index]] = new_index[target]
+
+    return optimized_ops, optimized_vals
+
+def _stack_error(op, depth, stack_size):
+    """Returns the problem an opcode runs into at the given stack depth,
+    or None if it has enough values and room on the stack"""
+    pops, pushes = STACK_EFFECTS[op]
+    if depth < pops:
+        return "Stack underflow"
+    if depth - pops + pushes > stack_size:
+        return "Stack overflow"
+    return None
+
+def verify(decoded, stack_size):
+    """Follows the stack depth through every reachable instruction of a
+    decoded source program, before optimize. A br/br_false whose offset is
+    loaded by the loadcon right before it jumps to a known target, and both
+    ways out of every conditional branch are followed.
+    Returns True when no instruction can underflow or overflow the stack,
+    False when that can't be proven: a branch offset is only known at run
+    time, an instruction is reached with different stack depths, or an
+    underflow or overflow is only reachable through a conditional branch.
+    Also False for a loadcon without a value, which pushes None.
+    Raises an Exception for an underflow or overflow on the path every run
+    takes from the first instruction, up to its first conditional branch
+    """
+    program_length = len(decoded)
+
+    # The instructions each instruction can continue with
+    successors = []
+    jump_targets = set()
+    for pc, (op, value) in enumerate(decoded):
+        if op == LOADCON_ID and value is None:
+            # the stepped path pushes None, which _run can't hold
+            return False
+        if op == BR_ID or op == BR_FALSE_ID:
+            if pc == 0 or decoded[pc - 1][0] != LOADCON_ID or decoded[pc - 1][1] is None:
+                return False
+            target = pc + 1 + decoded[pc - 1][1]
+        else:
+            successors.append((pc + 1,))
+            continue
+
+        if target < 0:
+            return False
+        jump_targets.add(target)
+        if op == BR_ID:
+            successors.append((target,))
+        else:
+            successors.append((pc + 1, target))
+
+    for target in jump_targets:
+        # jumping straight onto a br/br_false skips the loadcon for its offset
+        if target < program_length and decoded[target][0] in (BR_ID, BR_FALSE_ID):
+            return False
+
+    # Every run takes the path from the first instruction, so its problems
+    # are certain and rejected
+    depths = {} # the stack depth before each reached instruction
+    pc = 0
+    depth = 0
+    while pc < program_length and pc not in depths:
+        depths[pc] = depth
+        op = decoded[pc][0]
+        error = _stack_error(op, depth, stack_size)
+        if error:
+            raise Exception(f"{error} at instruction {pc}: {OPCODE_NAMES[op]}")
+        pops, pushes = STACK_EFFECTS[op]
+        depth += pushes - pops
+        if len(successors[pc]) != 1:
+            break
+        pc = successors[pc][0]
+
+    # Past a conditional branch a problem may never be reached at run time,
+    # so the program is only left to the checked opcode methods
+    depths = {0: 0}
+    pending = [0]
+    while pending:
+        pc = pending.pop()
+        if pc >= program_length:
+            continue
+        depth = depths[pc]
+        op = decoded[pc][0]
+        if _stack_error(op, depth, stack_size):
+            return False
+        pops, pushes = STACK_EFFECTS[op]
+        depth += pushes - pops
+
+        for successor in successors[pc]:
+            if successor >= program_length:
+                continue
+            if successor not in depths:
+                depths[successor] = depth
+                pending.append(successor)
+            elif depths[successor] != depth:
+                return False
+
+    return True
+
+ABSOLUTE_FN = ("loadcon 2", "loadcon 3", "negate", "add", "write")
 
 def main():
     # print("This is an interactive absolute function calculator built on a stack machine")
     # input_number = input("What number would you like to get the abs value of?:\t")
 
     # absolute_fn = [f"loadcon {input_number}", "dup", "zero", "less", "loadcon 3", "br_false", "one", "negate", "mpy", "write"]
-    
-    absolute_fn = ["loadcon 2", "loadcon 3", "negate", "add", "write"]
 
-    instructions = convert_list_to_instructions(absolute_fn)
-    sm = StackMachine(instructions)
+    sm = StackMachine.from_source(ABSOLUTE_FN, trace=True)
     sm.run()
     print(sm)
 